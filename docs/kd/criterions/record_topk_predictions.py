@@ -4,11 +4,13 @@
 # LICENSE file in the root directory of this source tree.
 
 from gzip import FTEXT
+import atexit
 import math
 import random
 import os
 from dataclasses import dataclass, field
 
+import numpy as np
 import torch
 from fairseq import metrics, utils
 from fairseq.criterions import FairseqCriterion, register_criterion
@@ -24,6 +26,12 @@ class LabelSmoothedCrossEntropyCriterionConfig(FairseqDataclass):
     )
     result_path: str = field(
         default='',
+        metadata={
+            "help": "directory to append the recorded predictions to. top{k}_records.bin holds "
+            "one packed binary record per non-pad target token: teacher top-k ids, student "
+            "top-k ids (int16, or int32 for vocabularies over 32767 entries) and the golden "
+            "target (int32)"
+        },
     )
     topk: int = field(
         default=-1,
@@ -40,7 +48,16 @@ class LabelSmoothedCrossEntropyCriterionConfig(FairseqDataclass):
     sentence_avg: bool = II("optimization.sentence_avg")
 
 
-def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None, reduce=True):
+def label_smoothing_constant(epsilon, vocab_size):
+    """Negative entropy of the smoothed target distribution, which turns the loss into a KL divergence."""
+    def xlogx(x):
+        return x * math.log(x) if x > 0 else 0.0
+
+    eps_i = epsilon / (vocab_size - 1)
+    return xlogx(1 - epsilon) + xlogx(eps_i) * (vocab_size - 1)
+
+
+def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None, reduce=True, const=None):
     if target.dim() == lprobs.dim() - 1:
         target = target.unsqueeze(-1)
     nll_loss = -lprobs.gather(dim=-1, index=target)
@@ -57,7 +74,9 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None, reduce=T
         smooth_loss = smooth_loss.sum()
     eps_i = epsilon / (lprobs.size(-1) - 1)
     loss = (1.0 - epsilon - eps_i) * nll_loss + eps_i * smooth_loss
-    loss = loss + ((1 - epsilon) * math.log(1 - epsilon) + eps_i * math.log(eps_i) * (lprobs.size(-1) - 1))
+    if const is None:
+        const = label_smoothing_constant(epsilon, lprobs.size(-1))
+    loss = loss + const
     return loss, nll_loss
 
 
@@ -82,6 +101,46 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         self.topk = topk
         self.ignore_prefix_size = ignore_prefix_size
         self.report_accuracy = report_accuracy
+        if self.result_path:
+            os.makedirs(self.result_path, exist_ok=True)
+        self._record_file = None
+        self._pinned_buffers = {}
+        self._ls_const_cache = {}
+        # token ids are recorded with the narrowest integer type holding the vocabulary
+        self.index_dtype = (
+            torch.int16 if len(task.target_dictionary) <= torch.iinfo(torch.int16).max else torch.int32
+        )
+
+    def _get_record_file(self):
+        # open the record file once and keep it for the whole run, so every batch
+        # costs a single buffered write instead of one write per token
+        if self._record_file is None:
+            if not self.result_path:
+                raise ValueError(
+                    "--result-path must be set to record the top-k predictions of a teacher"
+                )
+            self._record_file = open(
+                os.path.join(self.result_path, f'top{self.topk}_records.bin'), 'ab', buffering=1 << 20
+            )
+            atexit.register(self._close_record_file)
+        return self._record_file
+
+    def _close_record_file(self):
+        if self._record_file is not None:
+            self._record_file.close()
+            self._record_file = None
+
+    def _copy_to_pinned(self, name, tensor):
+        # asynchronous device-to-host copy into a reusable pinned buffer, grown on demand
+        if not tensor.is_cuda:
+            return tensor
+        buf = self._pinned_buffers.get(name)
+        if buf is None or buf.numel() < tensor.numel() or buf.dtype != tensor.dtype:
+            buf = torch.empty(tensor.numel(), dtype=tensor.dtype, pin_memory=True)
+            self._pinned_buffers[name] = buf
+        buf = buf[: tensor.numel()].view(tensor.shape)
+        buf.copy_(tensor, non_blocking=True)
+        return buf
 
     def forward(self, model, sample, teacher_model=None, reduce=True):
         """Compute the loss for the given sample.
@@ -92,21 +151,22 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         3) logging outputs to display while training
         """
         model.eval()
-        student_enc_out = model.encoder(
-            sample["net_input"]["src_tokens"], 
-            src_lengths=sample["net_input"]["src_lengths"], 
-            return_all_hiddens=True
-        )
-        student_dec_out = model.decoder(
-            sample["net_input"]["prev_output_tokens"],
-            encoder_out=student_enc_out,
-            features_only=False,
-            src_lengths=sample["net_input"]["src_lengths"],
-            return_all_hiddens=False,
-        )
+        # when recording predictions the loss is a constant zero, so the student
+        # outputs are only read and the forward can run in inference mode
+        with torch.inference_mode(teacher_model is not None):
+            student_enc_out = model.encoder(
+                sample["net_input"]["src_tokens"],
+                src_lengths=sample["net_input"]["src_lengths"],
+                return_all_hiddens=True
+            )
+            student_dec_out = model.decoder(
+                sample["net_input"]["prev_output_tokens"],
+                encoder_out=student_enc_out,
+                features_only=False,
+                src_lengths=sample["net_input"]["src_lengths"],
+                return_all_hiddens=False,
+            )
 
-        mle_loss, nll_loss = self.compute_loss(model, student_dec_out, sample, reduce=reduce)
-        
         if teacher_model is not None:
             with torch.no_grad():
                 teacher_model.eval()
@@ -127,30 +187,40 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             student_logits = student_dec_out[0]
             _, teacher_topk_preds = torch.topk(teacher_logits, k=self.topk, dim=-1)
             _, student_topk_preds = torch.topk(student_logits, k=self.topk, dim=-1)
-            result_path = self.result_path
-            if not os.path.exists(result_path):
-                os.mkdir(result_path)
-            teacher_preds = teacher_logits.argmax(-1)
-            student_preds = student_logits.argmax(-1)
-            acc = teacher_logits.argmax(-1).eq(sample['target'])
-            with open(os.path.join(result_path, f'teacher_top{self.topk}_preds.txt'), 'a+') as f_tea, \
-                open(os.path.join(result_path, f'student_top{self.topk}_preds.txt'), 'a+') as f_stu, \
-                open(os.path.join(result_path, 'golden_targets.txt'), 'a+') as f_gold:
-                for i in range(sample['target'].shape[0]):
-                    for j in range(sample['target'].shape[1]):
-                        if sample['target'][i, j] != self.padding_idx:
-                            tea_line = ' '.join(list(map(str, teacher_topk_preds[i, j].tolist()))) + '\n'
-                            stu_line = ' '.join(list(map(str, student_topk_preds[i, j].tolist()))) + '\n'
-                            gold_line = str(sample['target'][i, j].item()) + '\n'
-                            f_tea.write(tea_line)
-                            f_stu.write(stu_line)
-                            f_gold.write(gold_line)
-            
-            loss = mle_loss * 0.0
-            kd_loss1 = torch.zeros_like(loss)
-            kd_loss2 = torch.zeros_like(loss)
+            # narrow the int64 indices on device, so the host copy moves 2 (or 4) bytes per id
+            teacher_topk_preds = teacher_topk_preds.to(self.index_dtype)
+            student_topk_preds = student_topk_preds.to(self.index_dtype)
+            # one device-to-host copy per tensor and a single sync, then select the
+            # non-pad positions on cpu
+            target = self._copy_to_pinned('target', sample['target'].to(torch.int32))
+            tea_preds = self._copy_to_pinned('teacher', teacher_topk_preds)
+            stu_preds = self._copy_to_pinned('student', student_topk_preds)
+            if teacher_topk_preds.is_cuda:
+                torch.cuda.current_stream().synchronize()
+            target = target.numpy()
+            mask = target != self.padding_idx
+            tea_sel = tea_preds.numpy()[mask]
+            stu_sel = stu_preds.numpy()[mask]
+            records = np.empty(len(tea_sel), dtype=[
+                ('teacher', tea_sel.dtype, (self.topk,)),
+                ('student', stu_sel.dtype, (self.topk,)),
+                ('target', target.dtype),
+            ])
+            records['teacher'] = tea_sel
+            records['student'] = stu_sel
+            records['target'] = target[mask]
+            self._get_record_file().write(records.tobytes())
+
+            # recording only: the loss is a constant zero, so skip the mle loss entirely.
+            # it still requires grad so that the trainer's backward call is a no-op
+            loss = torch.zeros((), device=student_logits.device, requires_grad=True)
+            mle_loss = loss.detach()
+            nll_loss = loss.detach()
+            kd_loss1 = torch.zeros_like(mle_loss)
+            kd_loss2 = torch.zeros_like(mle_loss)
             
         else:
+            mle_loss, nll_loss = self.compute_loss(model, student_dec_out, sample, reduce=reduce)
             loss = mle_loss
             kd_loss1 = torch.zeros_like(loss)
             kd_loss2 = torch.zeros_like(loss)
@@ -170,7 +240,7 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             "sample_size": sample_size,
         }
         if self.report_accuracy:
-            n_correct, total = self.compute_accuracy(model, net_output, sample)
+            n_correct, total = self.compute_accuracy(model, student_dec_out, sample)
             logging_output["n_correct"] = utils.item(n_correct.data)
             logging_output["total"] = utils.item(total.data)
         return loss, sample_size, logging_output
@@ -189,34 +259,44 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
 
     def compute_loss(self, model, net_output, sample, reduce=True):
         lprobs, target = self.get_lprobs_and_target(model, net_output, sample)
+        vocab_size = lprobs.size(-1)
+        if vocab_size not in self._ls_const_cache:
+            self._ls_const_cache[vocab_size] = label_smoothing_constant(self.eps, vocab_size)
         loss, nll_loss = label_smoothed_nll_loss(
             lprobs,
             target,
             self.eps,
             ignore_index=self.padding_idx,
             reduce=reduce,
+            const=self._ls_const_cache[vocab_size],
         )
         return loss, nll_loss
 
     def compute_accuracy(self, model, net_output, sample):
         lprobs, target = self.get_lprobs_and_target(model, net_output, sample)
         mask = target.ne(self.padding_idx)
-        n_correct = torch.sum(
-            lprobs.argmax(1).masked_select(mask).eq(target.masked_select(mask))
-        )
-        total = torch.sum(mask)
+        n_correct = (lprobs.argmax(1).eq(target) & mask).sum()
+        total = mask.sum()
         return n_correct, total
 
     @classmethod
     def reduce_metrics(cls, logging_outputs) -> None:
         """Aggregate logging outputs from data parallel training."""
-        loss_sum = sum(log.get("loss", 0) for log in logging_outputs)
-        mle_loss_sum = sum(log.get("mle_loss", 0) for log in logging_outputs)
-        nll_loss_sum = sum(log.get("nll_loss", 0) for log in logging_outputs)
-        kd_loss1_sum = sum(log.get("kd_loss1", 0) for log in logging_outputs)
-        kd_loss2_sum = sum(log.get("kd_loss2", 0) for log in logging_outputs)
-        ntokens = sum(log.get("ntokens", 0) for log in logging_outputs)
-        sample_size = sum(log.get("sample_size", 0) for log in logging_outputs)
+        keys = (
+            "loss", "mle_loss", "nll_loss", "kd_loss1", "kd_loss2",
+            "ntokens", "sample_size", "total", "n_correct",
+        )
+        sums = dict.fromkeys(keys, 0)
+        for log in logging_outputs:
+            for key in keys:
+                sums[key] += log.get(key, 0)
+        loss_sum = sums["loss"]
+        mle_loss_sum = sums["mle_loss"]
+        nll_loss_sum = sums["nll_loss"]
+        kd_loss1_sum = sums["kd_loss1"]
+        kd_loss2_sum = sums["kd_loss2"]
+        ntokens = sums["ntokens"]
+        sample_size = sums["sample_size"]
 
         metrics.log_scalar(
             "loss", loss_sum / sample_size / math.log(2), sample_size, round=3
@@ -237,12 +317,10 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             "ppl", lambda meters: utils.get_perplexity(meters["nll_loss"].avg)
         )
 
-        total = utils.item(sum(log.get("total", 0) for log in logging_outputs))
+        total = utils.item(sums["total"])
         if total > 0:
             metrics.log_scalar("total", total)
-            n_correct = utils.item(
-                sum(log.get("n_correct", 0) for log in logging_outputs)
-            )
+            n_correct = utils.item(sums["n_correct"])
             metrics.log_scalar("n_correct", n_correct)
             metrics.log_derived(
                 "accuracy",
@@ -46,8 +46,8 @@ class LabelSmoothedCrossEntropyCriterion1(FairseqCriterion):
         self.sentence_avg = sentence_avg
         self.eps = label_smoothing
         self.range_eps = 0.01
-        self.queue = torch.cuda.FloatTensor([])
-        self.teacher_loss_queue = torch.cuda.FloatTensor([])
+        self.queue = torch.empty(0, device='cuda')
+        self.teacher_loss_queue = torch.empty(0, device='cuda')
         self.real_distil_rate = 0.0
         self.dict_count = None
         self.prior_tau = 1.0
@@ -78,7 +78,6 @@ class LabelSmoothedCrossEntropyCriterion1(FairseqCriterion):
         tensor = tensor.detach().view(-1)
         tensor_size = tensor.size(0)
         current_size = self.queue.size(0)
-        self.queue = self.queue.view(-1)
         if tensor_size + current_size < self.difficult_queue_size:
             self.queue = torch.cat((self.queue, tensor))
         else:
@@ -88,7 +87,6 @@ class LabelSmoothedCrossEntropyCriterion1(FairseqCriterion):
         tensor = tensor.detach().view(-1)
         tensor_size = tensor.size(0)
         current_size = self.teacher_loss_queue.size(0)
-        self.teacher_loss_queue = self.teacher_loss_queue.view(-1)
         if tensor_size + current_size < self.difficult_queue_size:
             self.teacher_loss_queue = torch.cat((self.teacher_loss_queue, tensor))
         else:
@@ -177,13 +175,11 @@ class LabelSmoothedCrossEntropyCriterion1(FairseqCriterion):
 
     def compute_loss(self, model, net_output, sample, reduce=True, teacher_output=None, distil_strategy="normal",
                      update_num=None):
-        probs = model.get_normalized_probs(net_output, log_probs=False)
+        lprobs = model.get_normalized_probs(net_output, log_probs=True)
         # t_probs = model.get_normalized_probs((net_output[0]/self.prior_tau,), log_probs=False)
         # t_lprobs = torch.log(t_probs)
-        lprobs = torch.log(probs)
         # t_probs = t_probs.view(-1, lprobs.size(-1))
         # t_lprobs = t_lprobs.view(-1, lprobs.size(-1))
-        probs = probs.view(-1, lprobs.size(-1))
         lprobs = lprobs.view(-1, lprobs.size(-1))
         target = model.get_targets(sample, net_output)
         bsz, seq_len = target.shape
@@ -38,6 +38,11 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None, reduce=T
     return loss, nll_loss
 
 
+def masked_kl_div(lprobs, probs, keep):
+    """KL(probs || exp(lprobs)) summed over the rows selected by the [N, 1] `keep` mask."""
+    return torch.sum(probs * (torch.log(probs.clamp_min(1e-12)) - lprobs) * keep)
+
+
 @register_criterion('label_smoothed_cross_entropy-adapter')
 class LabelSmoothedCrossEntropyCriterionAdapter(FairseqCriterion):
 
@@ -46,8 +51,6 @@ class LabelSmoothedCrossEntropyCriterionAdapter(FairseqCriterion):
         self.sentence_avg = sentence_avg
         self.eps = label_smoothing
         self.range_eps = 0.01
-        self.queue = torch.cuda.FloatTensor([])
-        self.teacher_loss_queue = torch.cuda.FloatTensor([])
         self.real_distil_rate = 0.0
         self.dict_count = None
         self.prior_tau = 1.0
@@ -56,17 +59,33 @@ class LabelSmoothedCrossEntropyCriterionAdapter(FairseqCriterion):
         self.retriever = Retriever(datastore=self.datastore, k=8)
         self.combiner = Combiner(lambda_=0.999,
                                  temperature=100, probability_dim=10152)
-
-        self.num = 0
-        self.teacher_model = None
+        self._retrieve_stream = torch.cuda.Stream()
+
+        # the teacher checkpoint is read on cpu here and moved to the training device
+        # by the first forward call, instead of stalling the first step with the load.
+        # the teacher is held in a plain list rather than assigned as an attribute, so it
+        # is not registered as a submodule: otherwise its parameters would go into the
+        # optimizer, the checkpoints and the DDP wrapper of the criterion. for the same
+        # reason the trainer's criterion.to()/.half() don't reach it.
+        from fairseq.checkpoint_utils import load_model_ensemble
+        checkpoints_paths = ['/home/mc/adapter-kd/ckpt/base2/deen/checkpoint_best.pt']
+        new_models, _ = load_model_ensemble(checkpoints_paths)
+        teacher_model = new_models[0]
+        teacher_model.requires_grad_(False)
+        teacher_model.eval()
+        self._teacher_holder = [teacher_model]
+        self._forward_impl = self._first_forward
 
         self.distil_strategy = 'direct'
         self.distil_rate = 0.8
         self.teacher_predict_temperature_schedule = None
         self.teacher_predict_temperature = 1.0
-        self.difficult_queue_size = 5000
         self.high_freq_words = None
 
+    @property
+    def teacher_model(self):
+        return self._teacher_holder[0]
+
     @staticmethod
     def add_args(parser):
         """Add criterion-specific arguments to the parser."""
@@ -75,44 +94,37 @@ class LabelSmoothedCrossEntropyCriterionAdapter(FairseqCriterion):
                             help='epsilon for label smoothing, 0 means no label smoothing')
         # fmt: on
 
-    def push_to_FIFO_queue(self, tensor):
-        tensor = tensor.detach().view(-1)
-        tensor_size = tensor.size(0)
-        current_size = self.queue.size(0)
-        self.queue = self.queue.view(-1)
-        if tensor_size + current_size < self.difficult_queue_size:
-            self.queue = torch.cat((self.queue, tensor))
-        else:
-            self.queue = torch.cat((self.queue[tensor_size:], tensor))
-
-    def push_to_teacher_FIFO_queue(self, tensor):
-        tensor = tensor.detach().view(-1)
-        tensor_size = tensor.size(0)
-        current_size = self.teacher_loss_queue.size(0)
-        self.teacher_loss_queue = self.teacher_loss_queue.view(-1)
-        if tensor_size + current_size < self.difficult_queue_size:
-            self.teacher_loss_queue = torch.cat((self.teacher_loss_queue, tensor))
-        else:
-            self.teacher_loss_queue = torch.cat((self.teacher_loss_queue[tensor_size:], tensor))
-
     def forward(self, model, sample, reduce=True, teacher_model=None, update_num=None):
-
-        if self.num == 0:
-            from fairseq.checkpoint_utils import load_model_ensemble
-            checkpoints_paths = ['/home/mc/adapter-kd/ckpt/base2/deen/checkpoint_best.pt']
-            new_models, _ = load_model_ensemble(checkpoints_paths)
-            self.teacher_model = new_models[0]
-            self.teacher_model.to('cuda:0')
-            self.teacher_model.eval()
-
-        self.num += 1
+        return self._forward_impl(model, sample, reduce=reduce, teacher_model=teacher_model,
+                                  update_num=update_num)
+
+    def _first_forward(self, model, sample, reduce=True, teacher_model=None, update_num=None):
+        # one-time setup, afterwards forward dispatches straight to _normal_forward.
+        # follow the student's device and dtype, e.g. fp16 under --fp16
+        student_param = next(model.parameters())
+        self.teacher_model.to(device=student_param.device, dtype=student_param.dtype)
+        self._forward_impl = self._normal_forward
+        return self._normal_forward(model, sample, reduce=reduce, teacher_model=teacher_model,
+                                    update_num=update_num)
+
+    def _normal_forward(self, model, sample, reduce=True, teacher_model=None, update_num=None):
+        use_teacher = self.teacher_model is not None and self.distil_strategy != 'normal'
+        current_stream = torch.cuda.current_stream()
+        if use_teacher:
+            # the side stream only waits for the inputs, before the student is queued
+            self._retrieve_stream.wait_stream(current_stream)
         net_output = model(**sample['net_input'])
         teacher_output = None
-        if self.teacher_model is not None and self.distil_strategy != 'normal':
-            with torch.no_grad():
+        if use_teacher:
+            # run the teacher and the faiss search on a side stream: the search only blocks
+            # the host on the teacher kernels, while the student forward queued on the
+            # default stream keeps running. The two waits order every use of the shared
+            # tensors across both streams, so no record_stream calls are needed.
+            with torch.no_grad(), torch.cuda.stream(self._retrieve_stream):
                 # teacher_output, query = model.forwards(**sample['net_input'])
                 teacher_output, query = self.teacher_model.forwards(**sample['net_input'])
                 self.retriever.retrieve(query, return_list=["vals", "distances"])
+            current_stream.wait_stream(self._retrieve_stream)
 
         loss, nll_loss, extra_result = self.compute_loss(model, net_output, sample, reduce=reduce,
                                                          teacher_output=teacher_output,
@@ -172,18 +184,12 @@ class LabelSmoothedCrossEntropyCriterionAdapter(FairseqCriterion):
 
     def compute_loss(self, model, net_output, sample, reduce=True, teacher_output=None, distil_strategy="normal",
                      update_num=None):
-        probs = model.get_normalized_probs(net_output, log_probs=False)
-        t_probs = model.get_normalized_probs((net_output[0] / self.prior_tau,), log_probs=False)
-        t_lprobs = torch.log(t_probs)
-        lprobs = torch.log(probs)
-        t_probs = t_probs.view(-1, lprobs.size(-1))
-        t_lprobs = t_lprobs.view(-1, lprobs.size(-1))
-        probs = probs.view(-1, lprobs.size(-1))
+        lprobs = model.get_normalized_probs(net_output, log_probs=True)
         lprobs = lprobs.view(-1, lprobs.size(-1))
-        target = model.get_targets(sample, net_output)
-        bsz, seq_len = target.shape
-        target = target.view(-1, 1)
+        target = model.get_targets(sample, net_output).view(-1, 1)
         pad_mask = target.eq(self.padding_idx).view(-1)
+        # multiplicative [N, 1] mask of non-pad rows, shared by the distillation losses
+        keep = (~pad_mask).unsqueeze(-1).to(lprobs.dtype)
         loss = None
         nll_loss = None
         extra_result = {}
@@ -197,10 +203,7 @@ class LabelSmoothedCrossEntropyCriterionAdapter(FairseqCriterion):
                 lprobs, target, self.eps, ignore_index=self.padding_idx, reduce=reduce,
             )
             nmt_prob = self.get_teacher_probs_direct(teacher_output)
-            KL_loss = F.kl_div(lprobs, nmt_prob, reduction='none')
-            KL_loss = KL_loss.sum(dim=-1)
-            KL_loss.masked_fill_(pad_mask, 0.)
-            KL_loss = KL_loss.sum()
+            KL_loss = masked_kl_div(lprobs, nmt_prob, keep)
             extra_result['KD_loss'] = KL_loss
             loss = KL_loss
 
@@ -227,10 +230,7 @@ class LabelSmoothedCrossEntropyCriterionAdapter(FairseqCriterion):
 
             distil_lprobs = knn_prob + nmt_prob
 
-            KL_loss = F.kl_div(lprobs, distil_lprobs, reduction='none')
-            KL_loss = KL_loss.sum(dim=-1)
-            KL_loss.masked_fill_(pad_mask, 0.)
-            KL_loss = KL_loss.sum()
+            KL_loss = masked_kl_div(lprobs, distil_lprobs, keep)
             extra_result['KD_loss'] = KL_loss
             loss = golden_loss + 2.0 * KL_loss
 
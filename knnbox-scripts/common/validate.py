@@ -192,8 +192,9 @@ def main(args, override_args=None):
 
     if knn_type in ["vanilla_knn_mt", "adaptive_knn_mt", "kernel_smoothed_knn_mt", "vanilla_knn_mt_visual", "plac_knn_mt", "robust_knn_mt"]:
         datastore.dump()    # dump to disk
-        datastore.build_faiss_index("keys", use_gpu=(not args.build_faiss_index_with_cpu))
-        datastore.build_faiss_index("hiddens", use_gpu=(not args.build_faiss_index_with_cpu))
+        use_fast_scan = getattr(args, "knn_faiss_fast_scan", False)
+        datastore.build_faiss_index("keys", use_gpu=(not args.build_faiss_index_with_cpu), use_fast_scan=use_fast_scan)
+        datastore.build_faiss_index("hiddens", use_gpu=(not args.build_faiss_index_with_cpu), use_fast_scan=use_fast_scan)
         ds_config = json.load(open(os.path.join(args.knn_datastore_path, "config.json"), "r"))
         hiddens_idx_shape = ds_config["data_infos"]["hiddens_idx"]["shape"]
         hiddens_idx = np.memmap(os.path.join(args.knn_datastore_path, "hiddens_idx.npy"), dtype=int, mode="r", shape=(hiddens_idx_shape[0],))
@@ -211,6 +212,8 @@ def main(args, override_args=None):
         with open(os.path.join(args.knn_datastore_path, "dic.txt"), "w") as f:
             for i in range(len(lst) - 1):
                 f.write(str(lst[i]) + " " + str(lst[i + 1]) + "\n")
+        bounds = np.array(lst, dtype=np.int32)
+        np.save(os.path.join(args.knn_datastore_path, "dic.npy"), np.stack([bounds[:-1], bounds[1:]], axis=1))
 
 
     elif knn_type == "greedy_merge_knn_mt":
@@ -19,6 +19,7 @@ class AdaptiveCombiner(nn.Module):
                  k_trainable=True,
                  lambda_trainable=True,
                  temperature_trainable=True,
+                 skip_gate_dim=None,
                  **kwargs
                  ):
         super().__init__()
@@ -30,9 +31,19 @@ class AdaptiveCombiner(nn.Module):
         self.k_trainable = k_trainable
         self.lambda_trainable = lambda_trainable
         self.temperature_trainable = temperature_trainable
+        self.skip_gate_dim = skip_gate_dim
         self.kwargs = kwargs
         self.mask_for_distance = None
 
+        # optional skip-retrieval gate, predicts from the decoder hidden state
+        # whether the current token benefits from knn retrieval at all
+        self.skip_gate = None
+        if skip_gate_dim is not None:
+            self.skip_gate = nn.Sequential(
+                nn.Linear(skip_gate_dim, 1),
+                nn.Sigmoid()
+            )
+
         # check 
         assert self.lambda_trainable or "lambda_" in kwargs, \
             "if lambda is not trainable, you should provide a fixed lambda_ value"
@@ -45,8 +56,11 @@ class AdaptiveCombiner(nn.Module):
 
         self.mu_calculator = MuCalculator(self.max_k, use_context_dis=True)
 
-    def get_knn_prob(self, vals, distances, device="cuda:0", cache_hidden=None, source_weight=0.0, **kwargs):
-        hiddens = kwargs["hiddens"]
+    def get_knn_prob(self, results, *, device="cuda:0", cache_hidden=None, source_weight=0.0):
+        r""" get knn probs from the retriever `results` dict """
+        vals = results["vals"]
+        distances = results["distances"]
+        hiddens = results["hiddens"]
         b, l, k, h = hiddens.shape
         retrieve_hidden = hiddens.float()
         cache_hidden = cache_hidden.float()
@@ -95,9 +109,17 @@ class AdaptiveCombiner(nn.Module):
 
         return knn_prob
 
-    def get_combined_prob(self, knn_prob, neural_model_logit, log_probs=False):
-        r""" get combined probs of knn_prob and neural_model_prob """
-        return calculate_combined_prob(knn_prob, neural_model_logit, self.lambda_, log_probs)
+    def get_skip_gate(self, hidden):
+        r""" get the retrieval gate of each token, shape [B, S] """
+        return self.skip_gate(hidden.detach()).squeeze(-1)
+
+    def get_combined_prob(self, knn_prob, neural_model_logit, log_probs=False, gate=None):
+        r""" get combined probs of knn_prob and neural_model_prob,
+        if gate is provided, lambda is scaled by it token by token """
+        lambda_ = self.lambda_
+        if gate is not None:
+            lambda_ = lambda_ * gate.unsqueeze(-1)
+        return calculate_combined_prob(knn_prob, neural_model_logit, lambda_, log_probs)
 
     def dump(self, path):
         r""" dump the adaptive knn-mt to disk """
@@ -108,6 +130,7 @@ class AdaptiveCombiner(nn.Module):
         config["k_trainable"] = self.k_trainable
         config["lambda_trainable"] = self.lambda_trainable
         config["temperature_trainable"] = self.temperature_trainable
+        config["skip_gate_dim"] = self.skip_gate_dim
         for k, v in self.kwargs.items():
             config[k] = v
         write_config(path, config)
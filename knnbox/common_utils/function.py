@@ -43,6 +43,33 @@ def write_config(path, config):
         json.dump(config, f, indent=6)
 
 
+def read_hidden_dic(path):
+    r"""
+    read the sentence ranges of the datastore under the `path` folder,
+    each row is the [start, end) range of one sentence inside the datastore.
+    the binary `dic.npy` is preferred; if it doesn't exist, `dic.txt` is
+    parsed and `dic.npy` is saved for the next time.
+
+    Args:
+        path:
+            folder where the datastore is stored
+
+    Returns:
+        np.int32 ndarray of shape (num_sentences, 2)
+    """
+    npy_file = os.path.join(path, "dic.npy")
+    if os.path.exists(npy_file):
+        return np.load(npy_file).astype(np.int32, copy=False)
+
+    dic = np.fromfile(os.path.join(path, "dic.txt"), dtype=np.int32, sep=" ").reshape(-1, 2)
+    try:
+        np.save(npy_file, dic)
+    except OSError:
+        # the datastore folder may be read-only, just parse it every time
+        pass
+    return dic
+
+
 def filter_pad_tokens(tokens, pad_idx=1):
     r"""
     given a int tensor, 
@@ -146,13 +146,14 @@ class Datastore:
         write_config(self.path, config)
 
 
-    def load_faiss_index(self, filename, move_to_gpu=True, verbose=True):
+    def load_faiss_index(self, filename, move_to_gpu=True, verbose=True, gpu_res=None):
         r"""
         load faiss index from disk
 
         Args:
             filename: the prefix of faiss_index file, for example `keys.faiss_index`, filename is `keys`
             move_to_gpu: wether move the faiss index to GPU
+            gpu_res: faiss gpu resources shared between indexes, a new one is created if None
         """
         index_path = os.path.join(self.path, filename+".faiss_index")
         # we open config file and get the shape
@@ -164,11 +165,12 @@ class Datastore:
                         path = index_path,
                         n_probe = 32,
                         move_to_gpu = move_to_gpu,
-                        verbose=verbose
+                        verbose=verbose,
+                        gpu_res=gpu_res
                         )
 
 
-    def build_faiss_index(self, name, verbose=True, do_pca=False, pca_dim=256, use_gpu=True):
+    def build_faiss_index(self, name, verbose=True, do_pca=False, pca_dim=256, use_gpu=True, use_fast_scan=False):
         r"""
         build faiss index for a data.
         the output file named name+.faiss_index
@@ -178,6 +180,7 @@ class Datastore:
             verbose: display detailed message
             do_pca: wether do a PCA when building faiss index
             pca_dim: if use PCA, the PCA output dim
+            use_fast_scan: build a 4-bit IVFPQFastScan index with faiss-cpu
         """
 
         if not isinstance(self.datas[name], Memmap):
@@ -191,6 +194,7 @@ class Datastore:
                     do_pca=do_pca,
                     pca_dim=pca_dim,
                     use_gpu=use_gpu,
+                    use_fast_scan=use_fast_scan,
                     verbose=verbose
                     )
 
@@ -18,6 +18,7 @@ def build_faiss_index(
                 do_pca = False,
                 pca_dim = 256, # if do_pca==True, reduce to pca_dim before faiss retrieve
                 use_gpu = True, # use faiss-gpu, othewise use faiss-cpu
+                use_fast_scan = False, # use 4-bit IVFPQFastScan, only supported by faiss-cpu
                 verbose=False
                 ):
     r""" 
@@ -28,6 +29,10 @@ def build_faiss_index(
     # set OMP_WAIT_POLICY=PASSIVE significantly speed up faiss-cpu
     os.environ["OMP_WAIT_POLICY"]="PASSIVE"
 
+    if use_fast_scan and use_gpu:
+        print("  > IVFPQFastScan is not supported by faiss-gpu, build the index with faiss-cpu")
+        use_gpu = False
+
     res = faiss.StandardGpuResources()
     capacity, dimension = shape
     progress_idx = 1
@@ -41,7 +46,11 @@ def build_faiss_index(
     if not os.path.exists(output_filename+".trained"):
         index_dim = pca_dim if do_pca else dimension
         quantizer = faiss.IndexFlatL2(index_dim)
-        index = faiss.IndexIVFPQ(quantizer, index_dim, n_centroids, code_size, 8)
+        if use_fast_scan:
+            # 4-bit PQ codes laid out for SIMD look-up tables
+            index = faiss.IndexIVFPQFastScan(quantizer, index_dim, n_centroids, code_size, 4)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, index_dim, n_centroids, code_size, 8)
         index.nprobe = n_probe
 
 
@@ -92,7 +101,7 @@ def build_faiss_index(
         if use_gpu:
             faiss.write_index(faiss.index_gpu_to_cpu(gpu_index), output_filename+".trained")
         else:
-            faiss.write(index, output_filename+".trained")
+            faiss.write_index(index, output_filename+".trained")
         if verbose:
             print("  > [{}/{}] writing index took {} s".format(progress_idx, total_progress, time.time() -start))
             progress_idx += 1
@@ -147,9 +156,11 @@ def build_faiss_index(
 
 
 def load_faiss_index(path, n_probe,
-            move_to_gpu=True, verbose=False):
+            move_to_gpu=True, verbose=False, gpu_res=None):
     r"""
-    load the faiss index"""
+    load the faiss index.
+    if `gpu_res` is provided, the index is moved to gpu with these shared
+    resources instead of a new StandardGpuResources"""
     print("[Start Loading Faiss Index]")
     if verbose:
         start_time = time.time()
@@ -161,10 +172,15 @@ def load_faiss_index(path, n_probe,
         sys.exit(1)
  
     index = faiss.read_index(path, faiss.IO_FLAG_ONDISK_SAME_DIR)
+    if move_to_gpu and isinstance(faiss.extract_index_ivf(index), faiss.IndexIVFPQFastScan):
+        # faiss-gpu can't hold a FastScan index, it stays on cpu
+        if verbose:
+            print("  > IVFPQFastScan index is kept on cpu")
+        move_to_gpu = False
     if move_to_gpu:
         if verbose:
             print("  > move faiss index to gpu")
-        res = faiss.StandardGpuResources()
+        res = gpu_res if gpu_res is not None else faiss.StandardGpuResources()
         co = faiss.GpuClonerOptions()
         co.useFloat16 = True
         index = faiss.index_cpu_to_gpu(res, 0, index, co)
@@ -1,8 +1,8 @@
 import os
 from typing import Any, Dict, List, Optional, Tuple
 
+import faiss
 import torch
-from line_profiler import LineProfiler
 from torch import Tensor
 from fairseq.models.fairseq_encoder import EncoderOut
 from fairseq.models.transformer import (
@@ -21,6 +21,7 @@ from knnbox.common_utils import (
     disable_model_grad,
     enable_module_grad,
     archs, filter_pad_tokens, filter_pad_hidden,
+    read_hidden_dic,
 )
 from knnbox.datastore import Datastore
 from knnbox.retriever import Retriever
@@ -71,7 +72,15 @@ class AdaptiveKNNMT(TransformerModel):
                             help="The directory to save/load adaptiveCombiner")
         parser.add_argument("--build-faiss-index-with-cpu", action="store_true", default=False,
                             help="use faiss-cpu instead of faiss-gpu (useful when gpu memory is small)")
+        parser.add_argument("--knn-faiss-fast-scan", action="store_true", default=False,
+                            help="build the faiss indexes as 4-bit IVFPQFastScan, which are built and "
+                            "searched with faiss-cpu SIMD kernels")
         parser.add_argument("--knn-u", type=float, metavar="D", default=0.0)
+        parser.add_argument("--knn-skip-gate", action="store_true", default=False,
+                            help="train a gate with the meta-k network to skip retrieval for tokens "
+                            "which don't benefit from knn")
+        parser.add_argument("--knn-skip-threshold", type=float, metavar="D", default=0.5,
+                            help="tokens whose skip gate is below this threshold don't use knn")
 
     @classmethod
     def build_decoder(cls, args, tgt_dict, embed_tokens):
@@ -97,6 +106,7 @@ class AdaptiveKNNMTDecoder(TransformerDecoder):
         In other words, create datastore, retriever and combiner.
         """
         super().__init__(args, dictionary, embed_tokens, no_encoder_attn)
+        self._knn_mode = args.knn_mode
 
         if args.knn_mode == "build_datastore":
             if "datastore" not in global_vars():
@@ -105,24 +115,32 @@ class AdaptiveKNNMTDecoder(TransformerDecoder):
                 # python file (when traverse the dataset and `add value`)
                 global_vars()["datastore"] = Datastore(args.knn_datastore_path)  
             self.datastore = global_vars()["datastore"]
+            self._forward_impl = self._forward_build_datastore
 
         else:
             self.datastore = Datastore.load(args.knn_datastore_path, load_list=["vals", "hiddens_idx", "hiddens", "keys"])
-            self.datastore.load_faiss_index("keys")
-            self.datastore.load_faiss_index("hiddens")
+            # both indexes share one faiss gpu resources with a bounded scratch memory,
+            # instead of reserving the default temp memory once per index
+            self._faiss_gpu_res = None
+            if not args.build_faiss_index_with_cpu:
+                self._faiss_gpu_res = faiss.StandardGpuResources()
+                self._faiss_gpu_res.setTempMemory(256 * 1024 * 1024)
+            self.datastore.load_faiss_index("keys", gpu_res=self._faiss_gpu_res)
+            self.datastore.load_faiss_index("hiddens", gpu_res=self._faiss_gpu_res)
             self.retriever = Retriever(datastore=self.datastore, k=args.knn_max_k)
 
-            self.hidden_dic = []
-            with open(os.path.join(args.knn_datastore_path, "dic.txt"), "r") as f:
-                tmp = f.readlines()
-                self.hidden_dic = [0] * len(tmp)
-                for i in range(len(tmp)):
-                    self.hidden_dic[i] = [int(x) for x in tmp[i].strip().split(" ")]
-            self.hidden_dic = torch.tensor(self.hidden_dic).cuda()
+            self.hidden_dic = torch.from_numpy(read_hidden_dic(args.knn_datastore_path))
+            self.hidden_dic = self.hidden_dic.pin_memory().cuda(non_blocking=True)
 
             self.gen_len = 1
             self.gen_end = None
 
+            # retrieval runs on its own stream, overlapped with the vocabulary projection
+            self.retrieve_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+            self._source_weight = float(args.source_weight)
+            self._knn_skip_threshold = args.knn_skip_threshold
+            self._forward_impl = self._forward_knn
+
             if args.knn_mode == "train_metak":
                 self.combiner = AdaptiveCombiner(
                     max_k=args.knn_max_k * 2,
@@ -131,7 +149,8 @@ class AdaptiveKNNMTDecoder(TransformerDecoder):
                     lambda_trainable=(args.knn_lambda_type == "trainable"),
                     lambda_=args.knn_lambda,
                     temperature_trainable=(args.knn_temperature_type == "trainable"),
-                    temperature=args.knn_temperature
+                    temperature=args.knn_temperature,
+                    skip_gate_dim=self.output_embed_dim if args.knn_skip_gate else None,
                 )
             elif args.knn_mode == "inference":
                 self.combiner = AdaptiveCombiner.load(args.knn_combiner_path)
@@ -160,7 +179,54 @@ class AdaptiveKNNMTDecoder(TransformerDecoder):
         
         when the action mode is `building datastore`, we save keys to datastore.
         when the action mode is `inference`, we retrieve the datastore with hidden state.
+
+        the implementation for the action mode is chosen once in `__init__`.
         """
+        return self._forward_impl(
+            prev_output_tokens,
+            encoder_out=encoder_out,
+            incremental_state=incremental_state,
+            features_only=features_only,
+            full_context_alignment=full_context_alignment,
+            alignment_layer=alignment_layer,
+            alignment_heads=alignment_heads,
+        )
+
+    def _forward_build_datastore(
+        self,
+        prev_output_tokens,
+        encoder_out=None,
+        incremental_state=None,
+        features_only=False,
+        full_context_alignment=False,
+        alignment_layer=None,
+        alignment_heads=None,
+    ):
+        r""" forward when building datastore, no retrieval is needed """
+        x, extra = self.extract_features(
+            prev_output_tokens,
+            encoder_out=encoder_out,
+            incremental_state=incremental_state,
+            full_context_alignment=full_context_alignment,
+            alignment_layer=alignment_layer,
+            alignment_heads=alignment_heads,
+        )
+
+        if not features_only:
+            x = self.output_layer(x)
+        return x, extra
+
+    def _forward_knn(
+        self,
+        prev_output_tokens,
+        encoder_out=None,
+        incremental_state=None,
+        features_only=False,
+        full_context_alignment=False,
+        alignment_layer=None,
+        alignment_heads=None,
+    ):
+        r""" forward when train metak or inference, retrieve the datastore with hidden state """
         self.gen_len = prev_output_tokens.shape[1]
         x, extra = self.extract_features(
             prev_output_tokens,
@@ -170,20 +236,94 @@ class AdaptiveKNNMTDecoder(TransformerDecoder):
             alignment_layer=alignment_layer,
             alignment_heads=alignment_heads,
         )
-        encoder_hidden = encoder_out[0].transpose(0, 1)
-        encoder_hidden = torch.mean(encoder_hidden, dim=1).unsqueeze(1)
-        self.cache_hidden = encoder_hidden
+        self.cache_hidden = self._get_cached_encoder_mean(encoder_out, incremental_state)
+
+        self.knn_gate = self._get_knn_gate(x)
 
-        # Not use adaptive knn-mt to build datastore, use vanilla knn-mt.
-        if self.args.knn_mode == "build_datastore":
-            pass
-        elif self.args.knn_mode == "inference" or self.args.knn_mode == "train_metak":
-            self.retriever.fast_faiss_retrieve_with_hidden(x, self.cache_hidden, self.hidden_dic, self.gen_len, self.args.knn_mode, return_list=["keys", "vals", "distances", "hiddens_idx", "hiddens", "indices"])
+        # the retrieval stream only waits for the decoder features; the vocabulary
+        # projection doesn't depend on knn results, so it is enqueued afterwards on the
+        # default stream and overlaps with retrieval, which blocks the host on faiss
+        # and datastore lookups
+        current_stream = torch.cuda.current_stream() if self.retrieve_stream is not None else None
+        if current_stream is not None:
+            self.retrieve_stream.wait_stream(current_stream)
 
+        features = x
         if not features_only:
             x = self.output_layer(x)
+
+        with torch.cuda.stream(self.retrieve_stream):
+            self._retrieve(features)
+        if current_stream is not None:
+            current_stream.wait_stream(self.retrieve_stream)
         return x, extra
-    
+
+    def _retrieve(self, features):
+        r"""
+        retrieve the datastore with the decoder features.
+        when inference with a skip gate, only the batch rows that have a gated-on token
+        are retrieved; the results of the other rows are zero-filled, and the gate zeroes
+        their lambda so they get the NMT probability.
+        """
+        keep_idx = None
+        # the first step always retrieves all rows, it fills the sentence-level cache of retriever
+        if self.knn_gate is not None and self._knn_mode == "inference" and self.gen_len != 1:
+            keep_idx = self.knn_gate.bool().any(dim=-1).nonzero().squeeze(-1)
+            if keep_idx.numel() == 0:
+                self.retriever.results = None
+                return
+            if keep_idx.numel() == features.size(0):
+                keep_idx = None
+
+        results = self.retriever.fast_faiss_retrieve_with_hidden(features, self.cache_hidden, self.hidden_dic, self.gen_len, self._knn_mode, return_list=["keys", "vals", "distances", "hiddens_idx", "hiddens", "indices"], keep_idx=keep_idx)
+        if keep_idx is not None:
+            for name, value in results.items():
+                if torch.is_tensor(value):
+                    full_value = value.new_zeros((features.size(0),) + value.shape[1:])
+                    full_value[keep_idx] = value
+                    results[name] = full_value
+
+    def _get_cached_encoder_mean(self, encoder_out, incremental_state):
+        r"""
+        mean-pooled encoder hidden of each sentence, shape [B, 1, C].
+        it is constant across decoding steps, so when decoding incrementally
+        we compute it at the first step and keep it inside incremental_state.
+        """
+        cached = self.get_incremental_state(incremental_state, "enc_mean")
+        if cached is not None:
+            return cached["enc_mean"]
+
+        # encoder_out[0] is T x B x C, reduce over T in place instead of transposing first
+        encoder_hidden = encoder_out[0].mean(dim=0).unsqueeze(1)
+        self.set_incremental_state(incremental_state, "enc_mean", {"enc_mean": encoder_hidden})
+        return encoder_hidden
+
+    def reorder_incremental_state(
+        self,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        new_order: Tensor,
+    ):
+        r""" reorder the cached encoder mean together with beam search """
+        cached = self.get_incremental_state(incremental_state, "enc_mean")
+        if cached is not None:
+            cached["enc_mean"] = cached["enc_mean"].index_select(0, new_order)
+            incremental_state = self.set_incremental_state(incremental_state, "enc_mean", cached)
+        return incremental_state
+
+    def _get_knn_gate(self, x):
+        r"""
+        get the per-token gate of knn retrieval, None if the combiner has no skip gate.
+        when inference, the gate is hard (0 or 1); when training, the hard gate is
+        trained through a straight-through estimator.
+        """
+        if self.combiner.skip_gate is None:
+            return None
+        gate = self.combiner.get_skip_gate(x)
+        hard_gate = (gate > self._knn_skip_threshold).to(gate)
+        if self._knn_mode == "inference":
+            return hard_gate
+        return hard_gate + gate - gate.detach()
+
 
     def get_normalized_probs(
         self,
@@ -198,9 +338,9 @@ class AdaptiveKNNMTDecoder(TransformerDecoder):
         step 2.
             combine the knn probability with NMT's probability 
         """
-        if self.args.knn_mode == "inference" or self.args.knn_mode == "train_metak":
-            knn_prob = self.combiner.get_knn_prob(**self.retriever.results, device=net_output[0].device, cache_hidden=self.cache_hidden, source_weight=self.args.source_weight)
-            combined_prob, _ = self.combiner.get_combined_prob(knn_prob, net_output[0], log_probs=log_probs)
+        if self._knn_mode != "build_datastore" and self.retriever.results is not None:
+            knn_prob = self.combiner.get_knn_prob(self.retriever.results, device=net_output[0].device, cache_hidden=self.cache_hidden, source_weight=self._source_weight)
+            combined_prob, _ = self.combiner.get_combined_prob(knn_prob, net_output[0], log_probs=log_probs, gate=self.knn_gate)
             return combined_prob
         else:
             return super().get_normalized_probs(net_output, log_probs, sample)
@@ -202,7 +202,7 @@ class PckKNNMTDecoder(TransformerDecoder):
             combine the knn probability with NMT's probability 
         """
         if self.args.knn_mode == "inference" or self.args.knn_mode == "train_metak":
-            knn_prob = self.combiner.get_knn_prob(**self.retriever.results, device=net_output[0].device)
+            knn_prob = self.combiner.get_knn_prob(self.retriever.results, device=net_output[0].device)
             combined_prob, _ = self.combiner.get_combined_prob(knn_prob, net_output[0], log_probs=log_probs)
             return combined_prob
         else:
@@ -1,5 +1,5 @@
 import torch
-from knnbox.retriever.utils import retrieve_k_nearest
+from knnbox.retriever.utils import retrieve_k_nearest, gather_rows
 
 class Retriever:
     def __init__(self, datastore, k):
@@ -11,6 +11,23 @@ class Retriever:
         self.train_idx_dic = None
         self.train_hidden_dic = None
         self.source_hidden = None
+        self._query_buffers = {}
+        self._sentence_constants = None
+
+    def _get_query_buffer(self, name, query):
+        r"""
+        return a reusable pinned host buffer to stage the faiss query of `name`,
+        it only grows when a bigger query comes. None for cpu queries.
+        """
+        if not query.is_cuda:
+            return None
+        dim = query.size(-1)
+        num = query.numel() // dim
+        buffer = self._query_buffers.get(name)
+        if buffer is None or buffer.size(0) < num or buffer.size(1) != dim:
+            buffer = torch.empty((num, dim), dtype=torch.float32, pin_memory=True)
+            self._query_buffers[name] = buffer
+        return buffer[:num]
 
     def retrieve(self, query, return_list=["vals", "distances"], k=None):
         r""" 
@@ -23,7 +40,8 @@ class Retriever:
             self.datastore.load_faiss_index("keys", move_to_gpu=True)
 
         query = query.detach()
-        faiss_results = retrieve_k_nearest(query, self.datastore.faiss_index["keys"], k)
+        faiss_results = retrieve_k_nearest(query, self.datastore.faiss_index["keys"], k,
+                                           query_buffer=self._get_query_buffer("keys", query))
 
         ret = {}
         if "distances" in return_list:
@@ -49,101 +67,102 @@ class Retriever:
         self.results = ret  # save the retrieved results
         return ret
 
-    @torch.no_grad()
-    def fast_faiss_retrieve_with_hidden(self, query, hiddens, hidden_dic, gen_len, knn_mode, return_list=["vals", "distances"], k=None):
+    def _get_sentence_constants(self, device):
+        r"""
+        the far away key used as padding and the index of the last key,
+        they are constant for a datastore so we create them only once
+        """
+        if self._sentence_constants is None or self._sentence_constants[1].device != device:
+            keys = self.datastore["keys"].data
+            extra_hidden_vector = torch.full((1, keys.shape[1]), 999, device=device, dtype=torch.float)
+            max_key_idx = torch.tensor(keys.shape[0] - 1, device=device)
+            self._sentence_constants = (extra_hidden_vector, max_key_idx)
+        return self._sentence_constants
+
+    def _retrieve_sentence_keys(self, hiddens, hidden_dic, device):
+        r"""
+        retrieve the most similar source sentences of the datastore with the
+        sentence-level hidden [B, 1, H], and gather the keys of these sentences.
+        return the datastore indices [B, 1, L] and the keys [B, 1, L, H] of them,
+        invalid positions are filled with a far away vector.
+        """
         ds_hiddens = self.datastore["hiddens"].data
         keys = self.datastore["keys"].data
-        extra_hidden_vector = torch.full((1, keys.shape[1]), 999, device=query.device, dtype=torch.float)
-
-        if knn_mode == "inference" and (gen_len == 1 or self.sentence_retri_hidden.shape[0] != query.shape[0]):
-            b, s, h = hiddens.shape
-            all_hiddens = ds_hiddens
-            dic = hidden_dic
-            faiss_hiddens = retrieve_k_nearest(hiddens, self.datastore.faiss_index["hiddens"], 1 * self.k)
-            hiddens_idx = faiss_hiddens["indices"].cpu().numpy()
-            retri_hiddens = torch.tensor(all_hiddens[hiddens_idx], device=query.device).float()
-            hiddens_idx = torch.tensor(hiddens_idx, device=query.device).long()
-            dis = torch.cdist(hiddens.unsqueeze(-2), retri_hiddens, p=2).squeeze(-2)
-
-            k = real_k = self.k * 1
-            sorted_dis, sorted_idx = torch.sort(dis, dim=-1)
-            sorted_idx = sorted_idx[:, :, :real_k]
-            real_hiddens_idx = hiddens_idx.gather(2, sorted_idx)
-            sorted_idx = real_hiddens_idx
-
-            dic_start = dic[sorted_idx[:, :, :real_k], 0]
-            dic_end = dic[sorted_idx[:, :, :real_k], 1]
-            dic_end = torch.where(dic_end - dic_start < 50, dic_end, dic_start + 50) # avoid too big datastore
-            max_len = (dic_end - dic_start).max().item()
-
-            max_key_idx = torch.tensor(keys.shape[0] - 1, device=query.device)
-            tmp_arange = torch.arange(max_len).unsqueeze(0).unsqueeze(0).unsqueeze(0).expand(b, s, k, -1).to(query.device)
-            tmp_arange = tmp_arange + dic_start.unsqueeze(-1)
-            tmp_arange = torch.where(tmp_arange < dic_end.unsqueeze(-1), tmp_arange, max_key_idx)
-            target_idx = tmp_arange.reshape(b, s, -1)
-            target_idx, _ = torch.sort(target_idx, dim=-1)
-            target_mask = target_idx != max_key_idx
-            new_len = torch.max(target_mask.long().sum(dim=-1))
-            target_idx = target_idx[:, :, :new_len]
-            self.sentence_retri_idx = target_idx
-
-            valid_mask = target_idx != max_key_idx
-            target_idx = target_idx * valid_mask
-            target_hidden = torch.tensor(keys[target_idx.cpu().numpy()], device=query.device).float()
-            new_extra_hidden_vector = extra_hidden_vector.unsqueeze(0).unsqueeze(0).expand(*target_hidden.shape)
-            target_hidden = torch.where(valid_mask.unsqueeze(-1).expand(-1, -1, -1, new_extra_hidden_vector.shape[-1]), target_hidden, new_extra_hidden_vector)
-            self.sentence_retri_hidden = target_hidden
+        extra_hidden_vector, max_key_idx = self._get_sentence_constants(device)
+
+        b, s, h = hiddens.shape
+        all_hiddens = ds_hiddens
+        dic = hidden_dic
+        faiss_hiddens = retrieve_k_nearest(hiddens, self.datastore.faiss_index["hiddens"], 1 * self.k,
+                                           query_buffer=self._get_query_buffer("hiddens", hiddens))
+        hiddens_idx = faiss_hiddens["indices"].cpu().numpy()
+        retri_hiddens = torch.tensor(gather_rows(all_hiddens, hiddens_idx), device=device).float()
+        hiddens_idx = torch.tensor(hiddens_idx, device=device).long()
+        dis = torch.cdist(hiddens.unsqueeze(-2), retri_hiddens, p=2).squeeze(-2)
+
+        k = real_k = self.k * 1
+        sorted_dis, sorted_idx = torch.sort(dis, dim=-1)
+        sorted_idx = sorted_idx[:, :, :real_k]
+        real_hiddens_idx = hiddens_idx.gather(2, sorted_idx)
+        sorted_idx = real_hiddens_idx
+
+        dic_start = dic[sorted_idx[:, :, :real_k], 0]
+        dic_end = dic[sorted_idx[:, :, :real_k], 1]
+        dic_end = torch.where(dic_end - dic_start < 50, dic_end, dic_start + 50) # avoid too big datastore
+        max_len = (dic_end - dic_start).max().item()
+
+        tmp_arange = torch.arange(max_len, device=device).unsqueeze(0).unsqueeze(0).unsqueeze(0).expand(b, s, k, -1)
+        tmp_arange = tmp_arange + dic_start.unsqueeze(-1)
+        tmp_arange = torch.where(tmp_arange < dic_end.unsqueeze(-1), tmp_arange, max_key_idx)
+        target_idx = tmp_arange.reshape(b, s, -1)
+        target_idx, _ = torch.sort(target_idx, dim=-1)
+        target_mask = target_idx != max_key_idx
+        new_len = torch.max(target_mask.long().sum(dim=-1))
+        target_idx = target_idx[:, :, :new_len]
+        ret_idx = target_idx
+
+        valid_mask = target_idx != max_key_idx
+        target_idx = target_idx * valid_mask
+        target_hidden = torch.tensor(gather_rows(keys, target_idx.cpu().numpy()), device=device).float()
+        new_extra_hidden_vector = extra_hidden_vector.unsqueeze(0).unsqueeze(0).expand(*target_hidden.shape)
+        target_hidden = torch.where(valid_mask.unsqueeze(-1).expand(-1, -1, -1, new_extra_hidden_vector.shape[-1]), target_hidden, new_extra_hidden_vector)
+        return ret_idx, target_hidden
+
+    @torch.no_grad()
+    def fast_faiss_retrieve_with_hidden(self, query, hiddens, hidden_dic, gen_len, knn_mode, return_list=["vals", "distances"], k=None, keep_idx=None):
+        r"""
+        if `keep_idx` is provided when inference, only these rows of the batch are retrieved
+        and the results only contain these rows. the sentence-level cache is still kept
+        for the whole batch.
+        """
+        if knn_mode == "inference" and (gen_len == 1 or self.sentence_retri_hidden.shape[0] != hiddens.shape[0]):
+            self.sentence_retri_idx, self.sentence_retri_hidden = \
+                self._retrieve_sentence_keys(hiddens, hidden_dic, query.device)
 
         if knn_mode == "inference":
-            dis = torch.cdist(query.unsqueeze(-2), self.sentence_retri_hidden, p=2).squeeze(-2)
+            sentence_retri_idx = self.sentence_retri_idx
+            sentence_retri_hidden = self.sentence_retri_hidden
+            if keep_idx is not None:
+                query = query.index_select(0, keep_idx)
+                sentence_retri_idx = sentence_retri_idx.index_select(0, keep_idx)
+                sentence_retri_hidden = sentence_retri_hidden.index_select(0, keep_idx)
+            dis = torch.cdist(query.unsqueeze(-2), sentence_retri_hidden, p=2).squeeze(-2)
             dis, idx = torch.sort(dis, dim=-1)
             idx = idx[:, :, :self.k * 1]
-            batch_idx = self.sentence_retri_idx.gather(2, idx)
-            batch_hiddens = self.sentence_retri_hidden.gather(2, idx.unsqueeze(-1).expand(-1, -1, -1, self.sentence_retri_hidden.shape[-1]))
+            batch_idx = sentence_retri_idx.gather(2, idx)
+            batch_hiddens = sentence_retri_hidden.gather(2, idx.unsqueeze(-1).expand(-1, -1, -1, sentence_retri_hidden.shape[-1]))
 
         if knn_mode == "train_metak":
+            # the source hidden is the same for all tokens of a sentence, so search
+            # the hiddens index once per sentence and share the keys over tokens
             b, s, h = query.shape
-            all_hiddens = ds_hiddens
-            dic = hidden_dic
-            hiddens = hiddens.expand(-1, s, -1)
-            faiss_hiddens = retrieve_k_nearest(hiddens, self.datastore.faiss_index["hiddens"], 1 * self.k)
-            hiddens_idx = faiss_hiddens["indices"].cpu().numpy()
-            retri_hiddens = torch.tensor(all_hiddens[hiddens_idx], device=query.device).float()
-            hiddens_idx = torch.tensor(hiddens_idx, device=query.device).long()
-            dis = torch.cdist(hiddens.unsqueeze(-2), retri_hiddens, p=2).squeeze(-2)
-
-            k = real_k = self.k * 1
-            sorted_dis, sorted_idx = torch.sort(dis, dim=-1)
-            sorted_idx = sorted_idx[:, :, :real_k]
-            real_hiddens_idx = hiddens_idx.gather(2, sorted_idx)
-            sorted_idx = real_hiddens_idx
-
-            dic_start = dic[sorted_idx[:, :, :real_k], 0]
-            dic_end = dic[sorted_idx[:, :, :real_k], 1]
-            dic_end = torch.where(dic_end - dic_start < 50, dic_end, dic_start + 50) # avoid too big datastore
-            max_len = (dic_end - dic_start).max().item()
-
-            max_key_idx = torch.tensor(keys.shape[0] - 1, device=query.device)
-            tmp_arange = torch.arange(max_len).unsqueeze(0).unsqueeze(0).unsqueeze(0).expand(b, s, k, -1).to(query.device)
-            tmp_arange = tmp_arange + dic_start.unsqueeze(-1)
-            tmp_arange = torch.where(tmp_arange < dic_end.unsqueeze(-1), tmp_arange, max_key_idx)
-            target_idx = tmp_arange.reshape(b, s, -1)
-            target_idx, _ = torch.sort(target_idx, dim=-1)
-            target_mask = target_idx != max_key_idx
-            new_len = torch.max(target_mask.long().sum(dim=-1))
-            target_idx = target_idx[:, :, :new_len]
-
-            valid_mask = target_idx != max_key_idx
-            target_idx = target_idx * valid_mask
-            target_hidden = torch.tensor(keys[target_idx.cpu().numpy()], device=query.device).float()
-            new_extra_hidden_vector = extra_hidden_vector.unsqueeze(0).unsqueeze(0).expand(*target_hidden.shape)
-            target_hidden = torch.where(valid_mask.unsqueeze(-1).expand(-1, -1, -1, new_extra_hidden_vector.shape[-1]), target_hidden, new_extra_hidden_vector)
-
-            dis = torch.cdist(query.unsqueeze(-2), target_hidden, p=2).squeeze(-2)
+            target_idx, target_hidden = self._retrieve_sentence_keys(hiddens, hidden_dic, query.device)
+
+            dis = torch.cdist(query, target_hidden.squeeze(1), p=2)
             dis, idx = torch.sort(dis, dim=-1)
             idx = idx[:, :, :self.k * 1]
-            batch_idx = target_idx.gather(2, idx)
-            batch_hiddens = target_hidden.gather(2, idx.unsqueeze(-1).expand(-1, -1, -1, target_hidden.shape[-1]))
+            batch_idx = target_idx.expand(-1, s, -1).gather(2, idx)
+            batch_hiddens = target_hidden.expand(-1, s, -1, -1).gather(2, idx.unsqueeze(-1).expand(-1, -1, -1, target_hidden.shape[-1]))
 
             torch.cuda.empty_cache()
 
@@ -153,7 +172,8 @@ class Retriever:
             self.datastore.load_faiss_index("keys", move_to_gpu=True)
 
         query = query.detach()
-        faiss_results = retrieve_k_nearest(query, self.datastore.faiss_index["keys"], k)
+        faiss_results = retrieve_k_nearest(query, self.datastore.faiss_index["keys"], k,
+                                           query_buffer=self._get_query_buffer("keys", query))
 
         ret = {}
         if "distances" in return_list:
@@ -171,13 +191,13 @@ class Retriever:
         indices = ret["indices"].cpu().numpy()
 
         if "vals" in return_list:
-            ret["vals"] = torch.tensor(self.datastore["vals"].data[indices], device=query.device)
+            ret["vals"] = torch.tensor(gather_rows(self.datastore["vals"].data, indices), device=query.device)
         if "hiddens_idx" in return_list:
-            ret["hiddens_idx"] = torch.tensor(self.datastore["hiddens_idx"].data[indices], device=query.device)
+            ret["hiddens_idx"] = torch.tensor(gather_rows(self.datastore["hiddens_idx"].data, indices), device=query.device)
         if "hiddens" in return_list:
-            ret["hiddens"] = torch.tensor(self.datastore["hiddens"].data[ret["hiddens_idx"].cpu().numpy()], device=query.device)
+            ret["hiddens"] = torch.tensor(gather_rows(self.datastore["hiddens"].data, ret["hiddens_idx"].cpu().numpy()), device=query.device)
         if "keys" in return_list:
-            ori_keys = torch.tensor(self.datastore["keys"].data[ori_indices], device=query.device)
+            ori_keys = torch.tensor(gather_rows(self.datastore["keys"].data, ori_indices), device=query.device)
             ret["keys"] = torch.cat([ori_keys, batch_hiddens], dim=-2)
         if "distances" in return_list:
             ret["distances"] = torch.cdist(query.unsqueeze(-2), ret["keys"].float(), p=2).squeeze(-2) # calculate the distance between query and retrieved keys
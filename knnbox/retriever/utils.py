@@ -1,17 +1,34 @@
 r""" some utils function used for retrieve """
+import numpy as np
 import torch
 
-def retrieve_k_nearest(query, faiss_index, k):
+def retrieve_k_nearest(query, faiss_index, k, query_buffer=None):
     r"""
-    use faiss to retrieve k nearest item
+    use faiss to retrieve k nearest item.
+    if a float32 cpu `query_buffer` (preferably pinned) of shape [N, dim] is
+    provided, the query is copied into it instead of a fresh host tensor.
     """
     query_shape = list(query.size())
 
     # TODO: i dont know why can't use view but must use reshape here 
-    distances, indices = faiss_index.search(
-                        query.detach().cpu().float().reshape(-1,query_shape[-1]).numpy(), k)
+    if query_buffer is not None:
+        query_buffer.copy_(query.detach().reshape(-1, query_shape[-1]))
+        query_array = query_buffer.numpy()
+    else:
+        query_array = query.detach().cpu().float().reshape(-1,query_shape[-1]).numpy()
+    distances, indices = faiss_index.search(query_array, k)
     
     distances = torch.tensor(distances, device=query.device).view(*query_shape[:-1], k)
     indices = torch.tensor(indices,device=query.device).view(*query_shape[:-1], k)
 
     return {"distances": distances, "indices": indices}
+
+
+def gather_rows(data, indices):
+    r"""
+    gather rows of a (memmap) array by an index array of any shape.
+    each distinct row is read only once and in ascending order, so rows
+    lying on the same page of the memmap are read together.
+    """
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+    return data[unique_indices][inverse.reshape(indices.shape)]
@@ -0,0 +1,77 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from knnbox.common_utils import read_hidden_dic
+from knnbox.retriever.utils import gather_rows
+
+
+class TestGatherRows(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        values = rng.randn(50, 8).astype(np.float32)
+        path = os.path.join(self.tmpdir, "keys.npy")
+        memmap = np.memmap(path, dtype=np.float32, mode="w+", shape=values.shape)
+        memmap[:] = values
+        memmap.flush()
+        self.data = np.memmap(path, dtype=np.float32, mode="r", shape=values.shape)
+
+    def tearDown(self):
+        del self.data
+        shutil.rmtree(self.tmpdir)
+
+    def test_matches_fancy_indexing(self):
+        # unsorted, with repeats, shaped like faiss results [batch, seq_len, k]
+        indices = np.random.RandomState(1).randint(0, 50, size=(3, 4, 5))
+        np.testing.assert_array_equal(gather_rows(self.data, indices), self.data[indices])
+
+    def test_single_row_repeated(self):
+        indices = np.full((2, 3), 7)
+        np.testing.assert_array_equal(gather_rows(self.data, indices), self.data[indices])
+
+
+class TestReadHiddenDic(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dic_lines = ["0 3", "3 10", "10 12", "12 40"]
+        with open(os.path.join(self.tmpdir, "dic.txt"), "w") as f:
+            f.write("\n".join(self.dic_lines) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _parse_text(self):
+        # the line by line parser read_hidden_dic replaced
+        return np.array([[int(x) for x in line.strip().split(" ")] for line in self.dic_lines])
+
+    def test_text_fallback(self):
+        dic = read_hidden_dic(self.tmpdir)
+        self.assertEqual(dic.dtype, np.int32)
+        np.testing.assert_array_equal(dic, self._parse_text())
+        # the parsed ranges are cached for the next load
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "dic.npy")))
+
+    def test_cached_npy_is_used(self):
+        first = read_hidden_dic(self.tmpdir)
+        os.remove(os.path.join(self.tmpdir, "dic.txt"))
+        second = read_hidden_dic(self.tmpdir)
+        self.assertEqual(second.dtype, np.int32)
+        np.testing.assert_array_equal(first, second)
+
+    def test_npy_cast_to_int32(self):
+        np.save(os.path.join(self.tmpdir, "dic.npy"), self._parse_text().astype(np.int64))
+        dic = read_hidden_dic(self.tmpdir)
+        self.assertEqual(dic.dtype, np.int32)
+        np.testing.assert_array_equal(dic, self._parse_text())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import importlib.util
+import math
+import os
+import unittest
+
+import tests.utils as test_utils
+import torch
+
+
+def load_record_topk_predictions():
+    # the kd criteria live under docs/kd and are not part of the fairseq package
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "docs", "kd", "criterions", "record_topk_predictions.py"
+    )
+    spec = importlib.util.spec_from_file_location("record_topk_predictions", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+record_topk_predictions = load_record_topk_predictions()
+
+
+def old_label_smoothing_constant(epsilon, vocab_size):
+    # the value label_smoothed_nll_loss used to recompute for every batch
+    eps_i = epsilon / (vocab_size - 1)
+    return (1 - epsilon) * math.log(1 - epsilon) + eps_i * math.log(eps_i) * (vocab_size - 1)
+
+
+class TestLabelSmoothingConstant(unittest.TestCase):
+    def setUp(self):
+        self.d = test_utils.dummy_dictionary(3)
+        pad, eos, unk, w1, w2, w3 = 1, 2, 3, 4, 5, 6  # noqa: F841
+        self.data = [
+            {
+                "source": torch.LongTensor([w1, eos]),
+                "target": torch.LongTensor([w1, eos]),
+            },
+            {
+                "source": torch.LongTensor([w1, eos]),
+                "target": torch.LongTensor([w1, w1, eos]),
+            },
+        ]
+        self.sample = next(test_utils.dummy_dataloader(self.data))
+
+        self.args = argparse.Namespace()
+        self.args.probs = (
+            torch.FloatTensor(
+                [
+                    [0.05, 0.05, 0.1, 0.05, 0.3, 0.4, 0.05],
+                    [0.05, 0.10, 0.2, 0.05, 0.2, 0.3, 0.10],
+                    [0.05, 0.15, 0.3, 0.05, 0.1, 0.2, 0.15],
+                ]
+            )
+            .unsqueeze(0)
+            .expand(2, 3, 7)
+        )
+        self.task = test_utils.TestTranslationTask.setup_task(self.args, self.d, self.d)
+        self.model = self.task.build_model(self.args)
+
+    def test_matches_old_formula(self):
+        for epsilon in (0.01, 0.1, 0.3):
+            for vocab_size in (7, 1000, 40000):
+                self.assertAlmostEqual(
+                    record_topk_predictions.label_smoothing_constant(epsilon, vocab_size),
+                    old_label_smoothing_constant(epsilon, vocab_size),
+                )
+
+    def test_no_smoothing(self):
+        self.assertEqual(record_topk_predictions.label_smoothing_constant(0.0, 7), 0.0)
+
+    def test_cached_loss_matches_per_batch_loss(self):
+        crit = record_topk_predictions.LabelSmoothedCrossEntropyCriterion(
+            self.task, sentence_avg=False, label_smoothing=0.1, result_path="", topk=1
+        )
+        net_output = self.model(**self.sample["net_input"])
+        lprobs, target = crit.get_lprobs_and_target(self.model, net_output, self.sample)
+        nll_loss = -lprobs.gather(dim=-1, index=target.unsqueeze(-1))
+        smooth_loss = -lprobs.sum(dim=-1, keepdim=True)
+        pad_mask = target.unsqueeze(-1).eq(crit.padding_idx)
+        nll_loss = nll_loss.masked_fill(pad_mask, 0.0).sum()
+        smooth_loss = smooth_loss.masked_fill(pad_mask, 0.0).sum()
+        eps_i = 0.1 / (lprobs.size(-1) - 1)
+        expected = (
+            (1.0 - 0.1 - eps_i) * nll_loss
+            + eps_i * smooth_loss
+            + old_label_smoothing_constant(0.1, lprobs.size(-1))
+        )
+
+        for _ in range(2):
+            loss, _ = crit.compute_loss(self.model, net_output, self.sample)
+            self.assertAlmostEqual(loss.item(), expected.item(), places=5)
+        self.assertEqual(list(crit._ls_const_cache), [lprobs.size(-1)])
+
+
+if __name__ == "__main__":
+    unittest.main()